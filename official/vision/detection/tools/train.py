@@ -8,8 +8,11 @@
 # "AS IS" BASIS, WITHOUT ARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 import argparse
 import bisect
+import concurrent.futures
+import contextlib
 import copy
 import functools
+import hashlib
 import importlib
 import multiprocessing as mp
 import os
@@ -20,17 +23,31 @@ from tabulate import tabulate
 import numpy as np
 
 import megengine as mge
+import megengine.functional as F
+import megengine.module as M
 from megengine import distributed as dist
 from megengine import jit
 from megengine import optimizer as optim
+from megengine.core import Buffer
 from megengine.data import DataLoader, Infinite, RandomSampler
 from megengine.data import transform as T
 
+try:
+    # lets operators of a traced graph be scheduled ahead of the others
+    from megengine._internal.config import opr_priority_scope
+    from megengine.core.graph import get_default_graph
+except ImportError:
+    opr_priority_scope = None
+
 from official.vision.detection.tools.data_mapper import data_mapper
 from official.vision.detection.tools.utils import (
     AverageMeter,
+    BackgroundLogger,
     DetectionPadCollator,
-    GroupedRandomSampler
+    DynamicLossScaler,
+    GroupedRandomSampler,
+    PrefetchIterator,
+    ThreadedCompose
 )
 
 logger = mge.get_logger(__name__)
@@ -53,7 +70,58 @@ def make_parser():
     parser.add_argument(
         "-d", "--dataset_dir", default="/data/datasets", type=str,
     )
+    parser.add_argument(
+        "--save_interval",
+        default=1,
+        type=int,
+        help="save weights every n epochs, the last epoch is always saved",
+    )
+    parser.add_argument(
+        "--start_method",
+        default="forkserver" if sys.platform.startswith("linux") else "spawn",
+        choices=["spawn", "forkserver"],
+        help="how to start the training processes for multiple gpus",
+    )
+    parser.add_argument(
+        "--num_workers",
+        default=None,
+        type=int,
+        help="dataloader workers per gpu, default min(cpu_count // ngpus, 8)",
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        default=2,
+        type=int,
+        help="number of batches prefetched in background, 0 to disable",
+    )
+    parser.add_argument(
+        "--allreduce_bucket_mb",
+        default=25,
+        type=float,
+        help="size of gradient buckets all-reduced together in MB, "
+        "0 to all-reduce each gradient separately",
+    )
+    parser.add_argument(
+        "--amp",
+        default="none",
+        choices=["none", "fp16"],
+        help="run the backbone convolutions in fp16 with dynamic loss scaling",
+    )
     parser.add_argument("--enable_sublinear", action="store_true")
+    parser.add_argument(
+        "--sublinear_mem_thresh",
+        default=12,
+        type=float,
+        help="enable sublinear automatically when gpu memory (GB) is below "
+        "this value, 0 to disable",
+    )
+    parser.add_argument(
+        "--sublinear_genetic_nr_iter",
+        default=0,
+        type=int,
+        help="iterations of genetic search for sublinear checkpoints, "
+        "0 to use the greedy search only",
+    )
 
     return parser
 
@@ -62,6 +130,10 @@ def main():
     parser = make_parser()
     args = parser.parse_args()
 
+    if args.save_interval < 1:
+        logger.error("--save_interval must be a positive integer")
+        sys.exit(1)
+
     # ------------------------ begin training -------------------------- #
     valid_nr_dev = mge.get_device_count("gpu")
     if args.ngpus == -1:
@@ -75,12 +147,23 @@ def main():
 
     logger.info("Device Count = %d", world_size)
 
+    # import the network once here, training processes inherit sys.path and
+    # get the module from sys.modules (or the fork server) afterwards
+    args.file = os.path.abspath(args.file)
+    sys.path.insert(0, os.path.dirname(args.file))
+    args.network_module = os.path.basename(args.file).split(".")[0]
+    importlib.import_module(args.network_module)
+
     log_dir = "log-of-{}".format(os.path.basename(args.file).split(".")[0])
     if not os.path.isdir(log_dir):
         os.makedirs(log_dir)
 
     if world_size > 1:
-        mp.set_start_method("spawn")
+        if args.start_method == "forkserver":
+            # modules imported by the fork server are inherited by every
+            # training process instead of being imported again in each of them
+            mp.set_forkserver_preload(["megengine", args.network_module])
+        mp.set_start_method(args.start_method)
         processes = list()
         for i in range(world_size):
             process = mp.Process(target=worker, args=(i, world_size, args))
@@ -104,8 +187,7 @@ def worker(rank, world_size, args):
         )
         logger.info("Init process group for gpu%d done", rank)
 
-    sys.path.insert(0, os.path.dirname(args.file))
-    current_network = importlib.import_module(os.path.basename(args.file).split(".")[0])
+    current_network = importlib.import_module(args.network_module)
 
     model = current_network.Net(current_network.Cfg(), batch_size=args.batch_size)
     params = model.parameters(requires_grad=True)
@@ -124,105 +206,238 @@ def worker(rank, world_size, args):
         weights = mge.load(args.weight_file)
         model.backbone.bottom_up.load_state_dict(weights)
 
+    if args.amp == "fp16":
+        cast_convs(model.backbone, "float16")
+
+    sublinear_cfg = build_sublinear_config(args, rank)
+    if rank == 0:
+        logger.info("Sublinear memory %s", "on" if sublinear_cfg else "off")
+
     if rank == 0:
         logger.info("Prepare dataset")
-    train_loader = iter(build_dataloader(model.batch_size, args.dataset_dir, model.cfg))
+    num_workers = args.num_workers
+    if num_workers is None:
+        num_workers = max(min((os.cpu_count() or 1) // world_size, 8), 1)
+    train_loader = iter(
+        build_dataloader(
+            model.batch_size,
+            args.dataset_dir,
+            model.cfg,
+            num_workers=num_workers,
+            prefetch_factor=args.prefetch_factor,
+            cache_dir="log-of-{}".format(os.path.basename(args.file).split(".")[0]),
+        )
+    )
+
+    # losses are summed up on device by the traced graph itself, and only
+    # copied to host when they are logged
+    loss_sum = Buffer(np.zeros(model.cfg.num_losses, dtype=np.float32))
+    # traced once and reused by all epochs, so the graph is compiled only once
+    train_func = build_train_func(
+        model,
+        opt,
+        loss_sum,
+        world_size,
+        sublinear_cfg,
+        args.allreduce_bucket_mb,
+        args.amp,
+    )
+
+    train_logger = BackgroundLogger(logger) if rank == 0 else None
+    save_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    save_future = None
 
     for epoch_id in range(model.cfg.max_epoch):
+        base_lr = get_base_lr(model, epoch_id, world_size)
         for param_group in opt.param_groups:
-            param_group["lr"] = (
-                model.cfg.basic_lr
-                * world_size
-                * model.batch_size
-                * (
-                    model.cfg.lr_decay_rate
-                    ** bisect.bisect_right(model.cfg.lr_decay_stages, epoch_id)
-                )
-            )
+            param_group["lr"] = base_lr
 
         tot_steps = model.cfg.nr_images_epoch // (model.batch_size * world_size)
         train_one_epoch(
             model,
             train_loader,
             opt,
+            train_func,
+            loss_sum,
             tot_steps,
             rank,
             epoch_id,
             world_size,
-            args.enable_sublinear,
+            train_logger,
         )
-        if rank == 0:
+        is_last_epoch = epoch_id == model.cfg.max_epoch - 1
+        if rank == 0 and ((epoch_id + 1) % args.save_interval == 0 or is_last_epoch):
             save_path = "log-of-{}/epoch_{}.pkl".format(
                 os.path.basename(args.file).split(".")[0], epoch_id
             )
-            mge.save(
-                {"epoch": epoch_id, "state_dict": model.state_dict()}, save_path,
+            # take a host copy of the weights here and pickle it to disk in the
+            # background while the next epoch is running
+            state_dict = {
+                k: np.copy(v if isinstance(v, np.ndarray) else v.numpy())
+                for k, v in model.state_dict().items()
+            }
+            if save_future is not None:
+                # re-raise errors of the previous save, if any
+                save_future.result()
+            save_future = save_executor.submit(
+                save_weights,
+                {"epoch": epoch_id, "state_dict": state_dict},
+                save_path,
             )
-            logger.info("dump weights to %s", save_path)
 
+    if save_future is not None:
+        save_future.result()
+    save_executor.shutdown(wait=True)
 
-def train_one_epoch(
+
+def save_weights(obj, save_path):
+    mge.save(obj, save_path)
+    logger.info("dump weights to %s", save_path)
+
+
+def build_train_func(
     model,
-    data_queue,
     opt,
-    tot_steps,
-    rank,
-    epoch_id,
+    loss_sum,
     world_size,
-    enable_sublinear=False,
+    sublinear_cfg=None,
+    allreduce_bucket_mb=0,
+    amp="none",
 ):
-    sublinear_cfg = jit.SublinearMemoryConfig() if enable_sublinear else None
+    bucket_size = int(allreduce_bucket_mb * 1024 ** 2) if world_size > 1 else 0
+    sgd_step = build_sgd_step(opt)
+    loss_scaler = DynamicLossScaler() if amp == "fp16" else None
+    loss_scale = loss_scaler.tensor if loss_scaler is not None else None
 
     @jit.trace(symbolic=True, sublinear_memory_config=sublinear_cfg)
     def propagate():
         loss_dict = model(model.inputs)
-        opt.backward(loss_dict["total_loss"])
+        grad_sum = None
+        if bucket_size > 0 or loss_scale is not None:
+            grad_sum = manual_backward(
+                opt, loss_dict["total_loss"], bucket_size, loss_scale
+            )
+        else:
+            opt.backward(loss_dict["total_loss"])
         losses = list(loss_dict.values())
-        return losses
+        F.add_update(loss_sum, F.concat([loss.reshape(1) for loss in losses]))
+        return grad_sum
+
+    def train_func():
+        opt.zero_grad()
+        grad_sum = propagate()
+        if loss_scaler is None:
+            sgd_step()
+            return
+        # skip the step when the fp16 gradients overflowed
+        found_inf = not np.isfinite(grad_sum.numpy()).all()
+        if not found_inf:
+            sgd_step()
+        loss_scaler.update(found_inf)
 
-    meter = AverageMeter(record_len=model.cfg.num_losses)
+    return train_func
+
+
+def train_one_epoch(
+    model,
+    data_queue,
+    opt,
+    train_func,
+    loss_sum,
+    tot_steps,
+    rank,
+    epoch_id,
+    world_size,
+    train_logger,
+):
+    zero_losses = np.zeros(model.cfg.num_losses, dtype=np.float32)
+    loss_sum.set_value(zero_losses)
     time_meter = AverageMeter(record_len=2)
+    step_times = np.zeros(2, dtype=np.float64)
     log_interval = model.cfg.log_interval
-    for step in range(tot_steps):
-        adjust_learning_rate(opt, epoch_id, step, model, world_size)
+
+    # everything below stays the same during the epoch, keep it out of the loop
+    base_lr = get_base_lr(model, epoch_id, world_size)
+    warm_iters = model.cfg.warm_iters if epoch_id == 0 else 0
+    param_groups = opt.param_groups
+    # losses_keys is only set by the first forward pass, so the log format is
+    # built when the first log is written
+    log_info_str = None
+    set_image = model.inputs["image"].set_value
+    set_gt_boxes = model.inputs["gt_boxes"].set_value
+    set_im_info = model.inputs["im_info"].set_value
+
+    def run_step(step):
+        # Warm up
+        if step < warm_iters:
+            lr = base_lr * (step + 1.0) / warm_iters
+            for param_group in param_groups:
+                param_group["lr"] = lr
 
         data_tik = time.time()
         mini_batch = next(data_queue)
         data_tok = time.time()
 
-        model.inputs["image"].set_value(mini_batch["data"])
-        model.inputs["gt_boxes"].set_value(mini_batch["gt_boxes"])
-        model.inputs["im_info"].set_value(mini_batch["im_info"])
+        set_image(mini_batch["data"])
+        set_gt_boxes(mini_batch["gt_boxes"])
+        set_im_info(mini_batch["im_info"])
 
         tik = time.time()
-        opt.zero_grad()
-        loss_list = propagate()
-        opt.step()
+        train_func()
         tok = time.time()
-
-        time_meter.update([tok - tik, data_tok - data_tik])
-
+        return tok - tik, data_tok - data_tik
+
+    first_step = 0
+    if epoch_id == 0:
+        # the first call traces and compiles the graph, run it ahead of the
+        # timed loop and log it on its own, so that the compile time (included
+        # in the train_time of step 0) does not show up in later logs
+        train_time, data_time = run_step(0)
         if rank == 0:
-            info_str = "e%d, %d/%d, lr:%f, "
-            loss_str = ", ".join(
-                ["{}:%f".format(loss) for loss in model.cfg.losses_keys]
+            log_info_str = get_log_info_str(model.cfg.losses_keys)
+            train_logger.info(
+                log_info_str,
+                epoch_id,
+                0,
+                tot_steps,
+                param_groups[0]["lr"],
+                *loss_sum.numpy(),
+                train_time,
+                data_time
+            )
+        loss_sum.set_value(zero_losses)
+        first_step = 1
+
+    for step in range(first_step, tot_steps):
+        step_times[0], step_times[1] = run_step(step)
+        time_meter.update(step_times)
+
+        if rank == 0 and step % log_interval == 0:
+            if log_info_str is None:
+                log_info_str = get_log_info_str(model.cfg.losses_keys)
+            # time_meter counts the steps since the last log
+            average_loss = loss_sum.numpy() / time_meter.cnt
+            train_logger.info(
+                log_info_str,
+                epoch_id,
+                step,
+                tot_steps,
+                param_groups[0]["lr"],
+                *average_loss,
+                *time_meter.average()
             )
-            time_str = ", train_time:%.3fs, data_time:%.3fs"
-            log_info_str = info_str + loss_str + time_str
-            meter.update([loss.numpy() for loss in loss_list])
-            if step % log_interval == 0:
-                average_loss = meter.average()
-                logger.info(
-                    log_info_str,
-                    epoch_id,
-                    step,
-                    tot_steps,
-                    opt.param_groups[0]["lr"],
-                    *average_loss,
-                    *time_meter.average()
-                )
-                meter.reset()
-                time_meter.reset()
+            loss_sum.set_value(zero_losses)
+            time_meter.reset()
+
+    if rank == 0:
+        train_logger.flush()
+
+
+def get_log_info_str(losses_keys):
+    info_str = "e%d, %d/%d, lr:%f, "
+    loss_str = ", ".join(["{}:%f".format(loss) for loss in losses_keys])
+    time_str = ", train_time:%.3fs, data_time:%.3fs"
+    return info_str + loss_str + time_str
 
 
 def get_config_info(config):
@@ -240,8 +455,183 @@ def get_config_info(config):
     return config_table
 
 
-def adjust_learning_rate(optimizer, epoch_id, step, model, world_size):
-    base_lr = (
+def get_trainable_params(optimizer):
+    return [
+        param
+        for param_group in optimizer.param_groups
+        for param in param_group["params"]
+        if param.requires_grad
+    ]
+
+
+@contextlib.contextmanager
+def null_scope():
+    yield
+
+
+def priority_scope(priority):
+    if opr_priority_scope is None:
+        return null_scope()
+    return opr_priority_scope(get_default_graph(), priority)
+
+
+def manual_backward(optimizer, loss, bucket_size=0, loss_scale=None, key="grad"):
+    """Same as ``optimizer.backward(loss)``, except that
+
+    * with ``loss_scale``, the loss is multiplied by it and the gradients are
+      divided by it again; the sum of all the gradients is returned, which is
+      not finite if any of them overflowed
+    * in distributed training, the gradients are flattened into buckets of about
+      ``bucket_size`` bytes and each bucket is all-reduced by a single collective
+    """
+    params = get_trainable_params(optimizer)
+    if loss_scale is not None:
+        loss = loss * loss_scale
+    grads = F.grad(loss, params, use_virtual_grad=False)
+    if loss_scale is not None:
+        grads = [grad / loss_scale for grad in grads]
+    if dist.is_distributed():
+        grads = bucketed_all_reduce(params, grads, bucket_size, key)
+
+    # accumulate into the grad buffers like optimizer.backward does, so that
+    # the optimizer step finds the gradients where it expects them
+    for i, (param, grad) in enumerate(zip(params, grads)):
+        if param.grad is None:
+            param.grad = Buffer(param.dtype, param.shape, device=param.device)
+        # the low priorities optimizer.backward gives to these updates
+        with priority_scope((1 << 30) - i):
+            F.add_update(param.grad, grad)
+
+    if loss_scale is None:
+        return None
+    grad_sum = 0
+    for grad in grads:
+        grad_sum = grad_sum + grad.sum()
+    return grad_sum
+
+
+def bucketed_all_reduce(params, grads, bucket_size, key):
+    """All-reduce mean of ``grads``, flattened into buckets of about
+    ``bucket_size`` bytes which are all-reduced by a single collective each"""
+    # fill buckets in reverse order, which is the order gradients are produced
+    buckets = [[]]
+    filled = 0
+    for index in reversed(range(len(params))):
+        nbytes = int(np.prod(params[index].shape)) * 4
+        if filled + nbytes > bucket_size and buckets[-1]:
+            buckets.append([])
+            filled = 0
+        buckets[-1].append(index)
+        filled += nbytes
+
+    world_size = dist.get_world_size()
+    reduced_grads = list(grads)
+    for bucket_id, bucket in enumerate(buckets):
+        flat_grad = F.concat([grads[index].reshape(-1) for index in bucket])
+        # give the all-reduces the highest priorities, in bucket order, so each
+        # one starts as soon as its gradients are ready and the communication
+        # overlaps with the rest of the backward pass
+        with priority_scope(-(2 ** 30) + bucket_id):
+            flat_grad = (
+                dist.all_reduce_sum(flat_grad, "{}_bucket_{}".format(key, bucket_id))
+                / world_size
+            )
+        offset = 0
+        for index in bucket:
+            shape = params[index].shape
+            size = int(np.prod(shape))
+            reduced_grads[index] = flat_grad[offset : offset + size].reshape(shape)
+            offset += size
+    return reduced_grads
+
+
+def cast_convs(module, dtype):
+    """Run the convolutions of ``module`` in ``dtype``. Inputs, weights and bias
+    are cast before each convolution and the result is cast back to float32, so
+    the weights, the norm layers and the losses all stay in float32. Only the
+    convolutions themselves run in ``dtype``: the activations between them are
+    still float32, and each convolution costs three extra casts, so neither the
+    activation memory nor the memory traffic is reduced."""
+
+    def _cast_conv(calc_conv):
+        def _calc_conv(inp, weight, bias):
+            if bias is not None:
+                bias = bias.astype(dtype)
+            out = calc_conv(inp.astype(dtype), weight.astype(dtype), bias)
+            return out.astype("float32")
+
+        return _calc_conv
+
+    for m in module.modules():
+        if isinstance(m, M.Conv2d):
+            m.calc_conv = _cast_conv(m.calc_conv)
+
+
+def build_sublinear_config(args, rank):
+    enable_sublinear = args.enable_sublinear
+    # activations dominate memory in detection training, so fall back to
+    # sublinear memory on small cards even if it was not asked for; the total
+    # memory of the card is used (not the free memory), so that every rank
+    # comes to the same decision and builds the same graph
+    if not enable_sublinear and args.sublinear_mem_thresh > 0:
+        if hasattr(mge, "get_mem_status_bytes"):
+            total_mem, _ = mge.get_mem_status_bytes()
+            enable_sublinear = total_mem < args.sublinear_mem_thresh * 1024 ** 3
+        elif rank == 0:
+            logger.warning(
+                "can not query gpu memory with this megengine, sublinear memory "
+                "is only enabled by --enable_sublinear"
+            )
+    if not enable_sublinear:
+        return None
+    return jit.SublinearMemoryConfig(genetic_nr_iter=args.sublinear_genetic_nr_iter)
+
+
+def build_sgd_step(optimizer):
+    """Do the update of the SGD ``optimizer`` as one traced graph, in which the
+    elemwise updates of all parameters get fused, instead of one eager update per
+    parameter. The learning rates are fed to the graph as tensors, so changing
+    them in ``param_groups`` needs no new trace."""
+    lrs = [
+        mge.tensor(np.array([param_group["lr"]], dtype=np.float32))
+        for param_group in optimizer.param_groups
+    ]
+    current_lrs = [param_group["lr"] for param_group in optimizer.param_groups]
+    momentum_buffers = {
+        param: Buffer(np.zeros(param.shape, dtype=np.float32))
+        for param_group in optimizer.param_groups
+        for param in param_group["params"]
+        if param.requires_grad and param_group["momentum"] != 0.0
+    }
+
+    @jit.trace(symbolic=True)
+    def sgd_update():
+        for param_group, lr in zip(optimizer.param_groups, lrs):
+            weight_decay = param_group["weight_decay"]
+            for param in param_group["params"]:
+                if not param.requires_grad:
+                    continue
+                grad = param.grad
+                if weight_decay != 0.0:
+                    grad = grad + param * weight_decay
+                if param in momentum_buffers:
+                    grad = F.add_update(
+                        momentum_buffers[param], grad, alpha=param_group["momentum"]
+                    )
+                F.add_update(param, grad * (-lr))
+
+    def sgd_step():
+        for i, param_group in enumerate(optimizer.param_groups):
+            if param_group["lr"] != current_lrs[i]:
+                current_lrs[i] = param_group["lr"]
+                lrs[i].set_value(np.array([current_lrs[i]], dtype=np.float32))
+        sgd_update()
+
+    return sgd_step
+
+
+def get_base_lr(model, epoch_id, world_size):
+    return (
         model.cfg.basic_lr
         * world_size
         * model.batch_size
@@ -250,11 +640,6 @@ def adjust_learning_rate(optimizer, epoch_id, step, model, world_size):
             ** bisect.bisect_right(model.cfg.lr_decay_stages, epoch_id)
         )
     )
-    # Warm up
-    if epoch_id == 0 and step < model.cfg.warm_iters:
-        lr_factor = (step + 1.0) / model.cfg.warm_iters
-        for param_group in optimizer.param_groups:
-            param_group["lr"] = base_lr * lr_factor
 
 
 def build_dataset(data_dir, cfg):
@@ -271,32 +656,84 @@ def build_dataset(data_dir, cfg):
     return data_mapper[data_name](**data_cfg)
 
 
-def build_sampler(train_dataset, batch_size, aspect_grouping=[1]):
+def build_sampler(
+    train_dataset, batch_size, aspect_grouping=[1], cache_dir=None, signature=None
+):
     def _compute_aspect_ratios(dataset):
+        if hasattr(dataset, "imgs") and hasattr(dataset, "ids"):
+            # read the annotation table directly instead of going through
+            # get_img_info for every single image
+            imgs = dataset.imgs
+            return np.fromiter(
+                (imgs[i]["height"] / imgs[i]["width"] for i in dataset.ids),
+                dtype=np.float64,
+                count=len(dataset.ids),
+            )
         aspect_ratios = []
         for i in range(len(dataset)):
             info = dataset.get_img_info(i)
             aspect_ratios.append(info["height"] / info["width"])
-        return aspect_ratios
+        return np.array(aspect_ratios, dtype=np.float64)
 
     def _quantize(x, bins):
-        return list(map(lambda y: bisect.bisect_right(sorted(bins), y), x))
+        return np.searchsorted(np.sort(bins), x, side="right")
 
     if len(aspect_grouping) == 0:
         return Infinite(RandomSampler(train_dataset, batch_size, drop_last=True))
 
-    aspect_ratios = _compute_aspect_ratios(train_dataset)
-    group_ids = _quantize(aspect_ratios, aspect_grouping)
+    cache_file = get_group_ids_cache_file(
+        cache_dir, signature, len(train_dataset), aspect_grouping
+    )
+    group_ids = None
+    if cache_file is not None and os.path.exists(cache_file):
+        group_ids = np.load(cache_file)
+        if len(group_ids) != len(train_dataset):
+            group_ids = None
+    if group_ids is None:
+        aspect_ratios = _compute_aspect_ratios(train_dataset)
+        group_ids = _quantize(aspect_ratios, aspect_grouping)
+        if cache_file is not None:
+            # several workers may write the same cache, so write then rename
+            tmp_file = "{}.{}.npy".format(cache_file, os.getpid())
+            np.save(tmp_file, group_ids)
+            os.replace(tmp_file, cache_file)
     return Infinite(GroupedRandomSampler(train_dataset, batch_size, group_ids))
 
 
-def build_dataloader(batch_size, data_dir, cfg):
+def get_dataset_signature(data_dir, cfg):
+    data_cfg = cfg.train_dataset
+    signature = [os.path.abspath(data_dir), sorted(data_cfg.items())]
+    if "ann_file" in data_cfg:
+        ann_file = os.path.join(data_dir, data_cfg["name"], data_cfg["ann_file"])
+        if os.path.exists(ann_file):
+            stat = os.stat(ann_file)
+            signature += [stat.st_mtime_ns, stat.st_size]
+    return repr(signature)
+
+
+def get_group_ids_cache_file(cache_dir, signature, dataset_len, aspect_grouping):
+    if cache_dir is None or signature is None:
+        return None
+    key = "{}-{}-{}".format(signature, dataset_len, list(aspect_grouping))
+    return os.path.join(
+        cache_dir, "group_ids_{}.npy".format(hashlib.md5(key.encode()).hexdigest()),
+    )
+
+
+def build_dataloader(
+    batch_size, data_dir, cfg, num_workers=2, prefetch_factor=2, cache_dir=None
+):
     train_dataset = build_dataset(data_dir, cfg)
-    train_sampler = build_sampler(train_dataset, batch_size)
+    train_sampler = build_sampler(
+        train_dataset,
+        batch_size,
+        cache_dir=cache_dir,
+        signature=get_dataset_signature(data_dir, cfg),
+    )
     train_dataloader = DataLoader(
         train_dataset,
         sampler=train_sampler,
-        transform=T.Compose(
+        transform=ThreadedCompose(
             transforms=[
                 T.ShortestEdgeResize(
                     cfg.train_image_short_size,
@@ -307,10 +744,17 @@ def build_dataloader(batch_size, data_dir, cfg):
                 T.ToMode(),
             ],
             order=["image", "boxes", "boxes_category"],
+            num_threads=batch_size,
         ),
-        collator=DetectionPadCollator(),
-        num_workers=2,
+        # batches are collated in a dataloader subprocess and serialized right
+        # away, so the collator can reuse its buffers there
+        collator=DetectionPadCollator(reuse_buffers=num_workers > 0),
+        num_workers=num_workers,
     )
+    # megengine's DataLoader has no prefetch_factor, so keep a queue of ready
+    # batches filled by a background thread instead
+    if prefetch_factor > 0:
+        return PrefetchIterator(train_dataloader, max_prefetch=prefetch_factor)
     return train_dataloader
 
 
@@ -6,13 +6,19 @@
 # Unless required by applicable law or agreed to in writing,
 # software distributed under the License is distributed on an
 # "AS IS" BASIS, WITHOUT ARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+import copy
+import os
+import queue
 import random
-from collections import defaultdict
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
 
+import megengine as mge
 from megengine.data import Collator, RandomSampler
+from megengine.data.transform import Compose
 
 from official.vision.detection.tools.data_mapper import data_mapper
 from official.vision.detection.tools.nms import py_cpu_nms
@@ -23,19 +29,101 @@ class AverageMeter:
 
     def __init__(self, record_len=1):
         self.record_len = record_len
-        self.sum = [0 for i in range(self.record_len)]
+        self.sum = np.zeros(self.record_len, dtype=np.float64)
         self.cnt = 0
 
     def reset(self):
-        self.sum = [0 for i in range(self.record_len)]
+        self.sum.fill(0)
         self.cnt = 0
 
     def update(self, val):
-        self.sum = [s + v for s, v in zip(self.sum, val)]
+        # accumulate in place, val can be a list or a reused numpy array
+        self.sum += val
         self.cnt += 1
 
     def average(self):
-        return [s / self.cnt for s in self.sum]
+        return self.sum / self.cnt
+
+
+class DynamicLossScaler:
+    """Loss scale for fp16 training, halved when the gradients overflow and
+    doubled after ``growth_interval`` steps without overflow"""
+
+    def __init__(self, init_scale=2.0 ** 16, growth_interval=2000):
+        self.scale = init_scale
+        self.growth_interval = growth_interval
+        self.tensor = mge.tensor(np.array([init_scale], dtype=np.float32))
+        self._good_steps = 0
+
+    def update(self, found_inf):
+        if found_inf:
+            self.scale /= 2.0
+            self._good_steps = 0
+        else:
+            self._good_steps += 1
+            if self._good_steps < self.growth_interval:
+                return
+            self.scale *= 2.0
+            self._good_steps = 0
+        self.tensor.set_value(np.array([self.scale], dtype=np.float32))
+
+
+class PrefetchIterator:
+    """Iterate over an iterable in a background thread, keeping at most
+    ``max_prefetch`` items ready in a bounded queue"""
+
+    _sentinel = object()
+
+    def __init__(self, iterable, max_prefetch=2):
+        self.queue = queue.Queue(maxsize=max_prefetch)
+        self.thread = threading.Thread(
+            target=self._produce, args=(iter(iterable),), daemon=True
+        )
+        self.thread.start()
+
+    def _produce(self, iterator):
+        try:
+            for item in iterator:
+                self.queue.put(item)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.queue.put(exc)
+        self.queue.put(self._sentinel)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self.queue.get()
+        if item is self._sentinel:
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+class BackgroundLogger:
+    """Format and write log messages in a daemon thread, so that slow log
+    outputs do not block the caller"""
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._consume, daemon=True)
+        self.thread.start()
+
+    def _consume(self):
+        while True:
+            msg, args = self.queue.get()
+            try:
+                self.logger.info(msg, *args)
+            finally:
+                self.queue.task_done()
+
+    def info(self, msg, *args):
+        self.queue.put((msg, args))
+
+    def flush(self):
+        self.queue.join()
 
 
 class GroupedRandomSampler(RandomSampler):
@@ -77,57 +165,119 @@ class GroupedRandomSampler(RandomSampler):
         raise NotImplementedError("len() of GroupedRandomSampler is not well-defined.")
 
 
+_transform_pool = (None, None)
+
+
+def _get_transform_pool(max_workers):
+    # one pool for each process, a pool inherited from the parent process by
+    # fork has no running threads
+    global _transform_pool  # pylint: disable=global-statement
+    pid, pool = _transform_pool
+    if pid != os.getpid():
+        pool = ThreadPoolExecutor(max_workers=max_workers)
+        _transform_pool = (os.getpid(), pool)
+    return pool
+
+
+class ThreadedCompose(Compose):
+    """Same as :class:`Compose`, but the samples of a batch are transformed by
+    ``num_threads`` threads at the same time (opencv releases the GIL)"""
+
+    def __init__(self, *args, num_threads=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_threads = num_threads
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # thread-local copies are neither picklable nor worth copying
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def apply_batch(self, inputs):
+        if self.num_threads <= 1:
+            return super().apply_batch(inputs)
+        pool = _get_transform_pool(self.num_threads)
+        return tuple(pool.map(self._apply_in_thread, inputs))
+
+    def _apply_in_thread(self, input):
+        # transforms keep the state of the current sample (e.g. the resized
+        # shape or whether it is flipped) between transforming its image and
+        # its boxes, so each thread works on its own copy of them
+        transform = getattr(self._local, "transform", None)
+        if transform is None:
+            transform = copy.deepcopy(self)
+            self._local.transform = transform
+        return transform.apply(input)
+
+
 class DetectionPadCollator(Collator):
-    def __init__(self, pad_value: float = 0.0):
+    """Pad and stack samples into batches
+
+    With ``reuse_buffers`` the batches are written into buffers owned by the
+    collator, which only grow when a larger batch comes, so no array is allocated
+    per batch. The returned arrays are then overwritten by the next call, which is
+    only safe when every batch is serialized right away, e.g. sent from a
+    dataloader subprocess to the main process.
+    """
+
+    def __init__(self, pad_value: float = 0.0, reuse_buffers: bool = False):
         super().__init__()
         self.pad_value = pad_value
+        self.reuse_buffers = reuse_buffers
+        self._buffers = dict()
 
     def apply(self, inputs):
         """
         assume order = ["image", "boxes", "boxes_category", "info"]
         """
-        batch_data = defaultdict(list)
-
-        for image, boxes, boxes_category, info in inputs:
-            batch_data["data"].append(image.astype(np.float32))
-            batch_data["gt_boxes"].append(
-                np.concatenate([boxes, boxes_category[:, np.newaxis]], axis=1).astype(
-                    np.float32
-                )
-            )
+        batch_size = len(inputs)
+        channels = inputs[0][0].shape[0]
+        max_height = max(image.shape[1] for image, _, _, _ in inputs)
+        max_width = max(image.shape[2] for image, _, _, _ in inputs)
+        max_instances = max(len(boxes) for _, boxes, _, _ in inputs)
+
+        data_shape = (batch_size, channels, max_height, max_width)
+        batch_data = dict(
+            data=self._get_buffer("data", data_shape),
+            gt_boxes=self._get_buffer("gt_boxes", (batch_size, max_instances, 5)),
+            im_info=self._get_buffer("im_info", (batch_size, 5)),
+        )
+        for value in batch_data.values():
+            value.fill(self.pad_value)
 
+        for i, (image, boxes, boxes_category, info) in enumerate(inputs):
             _, current_height, current_width = image.shape
             assert len(boxes) == len(boxes_category)
             num_instances = len(boxes)
-            info = [
+
+            batch_data["data"][i, :, :current_height, :current_width] = image
+            batch_data["gt_boxes"][i, :num_instances, :4] = boxes
+            batch_data["gt_boxes"][i, :num_instances, 4] = boxes_category
+            batch_data["im_info"][i] = [
                 current_height,
                 current_width,
                 info[0],
                 info[1],
                 num_instances,
             ]
-            batch_data["im_info"].append(np.array(info, dtype=np.float32))
-
-        for key, value in batch_data.items():
-            pad_shape = list(max(s) for s in zip(*[x.shape for x in value]))
-            pad_value = [
-                np.pad(
-                    v,
-                    self._get_padding(v.shape, pad_shape),
-                    constant_values=self.pad_value,
-                )
-                for v in value
-            ]
-            batch_data[key] = np.ascontiguousarray(pad_value)
 
         return batch_data
 
-    def _get_padding(self, original_shape, target_shape):
-        assert len(original_shape) == len(target_shape)
-        shape = []
-        for o, t in zip(original_shape, target_shape):
-            shape.append((0, t - o))
-        return tuple(shape)
+    def _get_buffer(self, key, shape):
+        if not self.reuse_buffers:
+            return np.empty(shape, dtype=np.float32)
+        size = int(np.prod(shape))
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size, dtype=np.float32)
+            self._buffers[key] = buffer
+        # a prefix of the flat buffer, so that the batch is still contiguous
+        return buffer[:size].reshape(shape)
 
 
 class DetEvaluator: